@@ -24,7 +24,7 @@ def get_local_time():
 
         salt '*' time_functions.get_local_time
     '''
-    return str(datetime.datetime.now())
+    return datetime.datetime.now().isoformat(sep=' ')
 
 
 def get_utc_time():
@@ -35,19 +35,19 @@ def get_utc_time():
 
         salt '*' time_functions.get_utc_time
     '''
-    return str(datetime.datetime.utcnow())
+    return datetime.datetime.utcnow().isoformat(sep=' ')
 
 
 def get_local_epoch_time():
     '''
-    Get the time and display it in localized seconds since epoch.
+    Get the time and display it in seconds since epoch. Epoch time does not depend on the timezone, so this
+    is the same value as get_utc_epoch_time.
 
     .. code-block:: bash
 
         salt '*' time_functions.get_epoch_time
     '''
-    d = datetime.datetime.now()
-    return int(time.mktime(d.timetuple()))
+    return int(time.time())
 
 
 def get_utc_epoch_time():
@@ -58,5 +58,4 @@ def get_utc_epoch_time():
 
         salt '*' time_functions.get_epoch_time
     '''
-    d = datetime.datetime.utcnow()
-    return int(time.mktime(d.timetuple()))
+    return int(time.time())
@@ -12,19 +12,29 @@
 # NOTES:
 #
 
-import sys
+import atexit
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-from sys import exit
 
 # Import Salt libs
 import salt.utils
+import salt.exceptions
 
 log = logging.getLogger(__name__)
 
 __virtualname__ = 'virsh'
 
+# Number of libvirt calls the *_matching functions make at the same time
+_MAX_WORKERS = 8
+
+# Hypervisor connection shared between calls, opened on first use. It is only reused when the minion runs jobs
+# as threads (multiprocessing: False); with Salt's default of a forked process per job it lasts a single call.
+# Each time the loader re-executes this module another atexit hook is registered, so a connection held by an
+# older copy of the module stays open until the interpreter exits.
+_CONN = None
+
 # Import third party libs
 try:
     import libvirt
@@ -43,32 +53,58 @@ def __virtual__():
         return (False, 'The libvirt execution module failed to load: the libvirt python library is not available.')
 
 
+def _close_libvirt():
+    '''Close the cached hypervisor connection, if there is one.'''
+    global _CONN
+    if _CONN is not None:
+        try:
+            _CONN.close()
+        except libvirt.libvirtError:
+            pass
+        _CONN = None
+
+
+atexit.register(_close_libvirt)
+
+
 def _connect_to_libvirt():
+    '''Return the cached hypervisor connection, reopening it if it is no longer alive.'''
+    global _CONN
+    if _CONN is not None:
+        try:
+            if _CONN.isAlive():
+                return _CONN
+        except libvirt.libvirtError:
+            pass
+        _close_libvirt()
+
     conn = libvirt.open("qemu:///system")
 
     if conn is None:
         log.debug("Failed to open a connection to the hypervisor.")
-        exit(1)
+        raise libvirt.libvirtError("cannot connect to qemu:///system")
     else:
+        _CONN = conn
         return conn
 
 
-def _list_vms(state=0):
-    '''Worker function that provides data back to all the list functions.'''
+def _compile_match(match):
+    '''Compile a VM name regex, case insensitive; names are single line so no DOTALL/MULTILINE.'''
+    return re.compile(match, re.IGNORECASE)
+
+
+def _list_vms(flags=0):
+    '''Worker function that provides data back to all the list functions. The flags bitmask is passed straight\
+    through to listAllDomains so libvirtd only returns the domains that were asked for.'''
     conn = _connect_to_libvirt()
 
     try:
-        domains = conn.listAllDomains(state)
-        conn.close()
-    except:
-        error = sys.exc_info()[0]
-        log.debug("Unable to list VMs: {}".format(error))
+        domains = conn.listAllDomains(flags)
+    except libvirt.libvirtError as e:
+        log.debug("Unable to list VMs: %s", e)
         return False
 
-    vm_list = []
-    for domain in domains:
-        vm_list.append(domain.name())
-    return vm_list
+    return [domain.name() for domain in domains]
 
 
 def list(match='.*', state='all'):
@@ -80,25 +116,23 @@ def list(match='.*', state='all'):
         salt '*' virsh.list [match='regex'] [state=all|running|shutdown]
     '''
     if state == 'all':
-        code = 0
+        flags = libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE | libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE
     elif state == 'running':
-        code = 1
+        flags = libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE
     elif state == 'shutdown':
-        code = 2
+        flags = libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE
     else:
-        log.debug("Invalid State: {0}".format(state))
-        exit(1)
-
-    log.info("Listing {0} VMs".format(state))
-    vm_list = _list_vms(code)
-    matching_list = []
-    if vm_list is not False:
-        log.debug("Looking for matches in: {0}".format(vm_list))
-        for domain in vm_list:
-            log.debug("Checking if match: {0} to {1}".format(match, domain))
-            if re.search(match, domain, re.I | re.S | re.M) is not None:
-                log.debug("Adding {0} to list".format(domain))
-                matching_list.append(domain)
+        raise salt.exceptions.SaltInvocationError("Invalid state: {0}".format(state))
+
+    log.info("Listing %s VMs", state)
+    vm_list = _list_vms(flags)
+    if vm_list is not False and match == '.*':
+        # Everything matches, no need to check each name
+        return vm_list
+    elif vm_list is not False:
+        pattern = _compile_match(match)
+        matching_list = [domain for domain in vm_list if pattern.search(domain) is not None]
+        log.debug("Looking for matches to %s in %s, found: %s", match, vm_list, matching_list)
         return matching_list
     else:
         log.debug("Could not get the VM list")
@@ -116,14 +150,12 @@ def reboot(domain):
     '''
     conn = _connect_to_libvirt()
 
-    log.info("Reboot".format(domain))
+    log.info("Rebooting: %s", domain)
     try:
         dom = conn.lookupByName(domain)
         dom.reboot(0)
-        conn.close()
-    except:
-        error = sys.exc_info()[0]
-        log.debug("Reboot failed: {0}".format(error))
+    except libvirt.libvirtError as e:
+        log.debug("Reboot failed: %s", e)
         return False
     return True
 
@@ -139,23 +171,22 @@ def shutdown(domain, force=False):
     '''
     conn = _connect_to_libvirt()
 
-    log.info("Shutting down: {0}".format(domain))
+    log.info("Shutting down: %s", domain)
     try:
         dom = conn.lookupByName(domain)
         if force is True:
             dom.destroy()
         else:
             dom.shutdown()
-        conn.close()
-    except:
-        error = sys.exc_info()[0]
-        log.debug("Shutdown failed: {0}".format(error))
+    except libvirt.libvirtError as e:
+        log.debug("Shutdown failed: %s", e)
         return False
     return True
 
 
 def shutdown_matching(match='.*', force=False):
-    '''Attempt to shutdown all VMs that start with a particular string. Optionally, force the shutdown.
+    '''Attempt to shutdown all VMs that start with a particular string. Optionally, force the shutdown. Returns the\
+    names of the matching VMs that were shut down.
 
     CLI Example:
 
@@ -163,32 +194,36 @@ def shutdown_matching(match='.*', force=False):
 
         salt '*' virsh.shutdown_matching [match='regex'] [force=True]
     '''
+    pattern = _compile_match(match)
     conn = _connect_to_libvirt()
-    domains = []
 
     try:
         domain_objects = conn.listAllDomains(0)
-        for domain in domain_objects:
-            domains.append(domain.name())
-    except:
-        log.debug("Failed to get a list of domains: {0}".format(sys.exc_info()[0]))
+    except libvirt.libvirtError as e:
+        log.debug("Failed to get a list of domains: %s", e)
         return False
 
-    log.debug("Domains: {0}".format(domains))
-    for domain in domains:
-        log.debug("Checking if match: {0}".format(domain))
-        if re.search(match, domain, re.I | re.S | re.M) is not None:
-            log.info("Shutting down: {0}".format(domain))
-            try:
-                dom = conn.lookupByName(domain)
+    futures = []
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        for dom in domain_objects:
+            domain = dom.name()
+            log.debug("Checking if match: %s", domain)
+            if pattern.search(domain) is not None:
+                log.info("Shutting down: %s", domain)
                 if force is True:
-                    dom.destroy()
+                    futures.append((executor.submit(dom.destroy), domain))
                 else:
-                    dom.shutdown()
-            except:
-                log.debug("Failed to shutdown domain: {0}".format(sys.exc_info()[0]))
-    conn.close()
-    return domains
+                    futures.append((executor.submit(dom.shutdown), domain))
+
+    results = []
+    for future, domain in futures:
+        try:
+            future.result()
+        except libvirt.libvirtError as e:
+            log.debug("Failed to shutdown domain %s: %s", domain, e)
+        else:
+            results.append(domain)
+    return results
 
 
 def start(domain):
@@ -205,17 +240,17 @@ def start(domain):
     try:
         dom = conn.lookupByName(domain)
         dom.create()
-        conn.close()
         return True
-    except:
-        log.debug("Failed to start domain: {0}".format(sys.exc_info()[0]))
-        conn.close()
+    except libvirt.libvirtError as e:
+        log.debug("Failed to start domain: %s", e)
         return False
 
 
 def start_matching(match='.*', sleep_secs=1):
     '''Attempt to start all VMs that match a regex. By default the regex matches everything. The optional argument\
-    sleep_secs, sleeps for the specified number of seconds between starting up VMs.
+    sleep_secs, sleeps for the specified number of seconds between starting up VMs. The VMs are started in\
+    parallel, so sleep_secs only staggers when each one is kicked off. Returns the names of the matching\
+    VMs that were started.
 
     CLI Example:
 
@@ -223,25 +258,32 @@ def start_matching(match='.*', sleep_secs=1):
 
         salt '*' virsh.start_matching [match='regex'] [sleep_secs=1]
     '''
+    pattern = _compile_match(match)
     conn = _connect_to_libvirt()
-    domains = []
     try:
         domain_objects = conn.listAllDomains(0)
-        for domain in domain_objects:
-            domains.append(domain.name())
-    except:
-        log.debug("Failed to get a list of domains: {0}".format(sys.exc_info()[0]))
+    except libvirt.libvirtError as e:
+        log.debug("Failed to get a list of domains: %s", e)
         return False
 
-    log.debug("Domains: {0}".format(domains))
-    for domain in domains:
-        log.debug("Checking if match: {0}".format(domain))
-        if re.search(match, domain, re.I | re.S | re.M) is not None:
-            log.info("Starting: {0}".format(domain))
-            try:
-                dom = conn.lookupByName(domain)
-                dom.create()
-            except:
-                log.debug("Failed to start domain: {0}".format(sys.exc_info()[0]))
-    conn.close()
-    return domains
+    futures = []
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        for dom in domain_objects:
+            domain = dom.name()
+            log.debug("Checking if match: %s", domain)
+            if pattern.search(domain) is not None:
+                # Stagger the submissions rather than waiting for each VM to finish starting
+                if futures:
+                    sleep(sleep_secs)
+                log.info("Starting: %s", domain)
+                futures.append((executor.submit(dom.create), domain))
+
+    results = []
+    for future, domain in futures:
+        try:
+            future.result()
+        except libvirt.libvirtError as e:
+            log.debug("Failed to start domain %s: %s", domain, e)
+        else:
+            results.append(domain)
+    return results
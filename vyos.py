@@ -42,7 +42,9 @@
 """
 
 import re
+import atexit
 import logging
+import threading
 
 # Import third party libs
 try:
@@ -56,13 +58,36 @@ vyos_dir = '/opt/vyatta/'
 api = '{}/sbin/my_cli_shell_api'.format(vyos_dir)
 __virtualname__ = 'vyos'
 
+# Sent around every command so its output can be delimited without closing the shell. The quotes and $? keep
+# the markers from matching the shell's echo of the command line itself.
+_BEGIN_MARKER_COMMAND = 'echo __BEGIN""__'
+_BEGIN_MARKER = re.compile(r'__BEGIN__\r?\n')
+_END_MARKER_COMMAND = 'echo __END__$?__'
+_END_MARKER = re.compile(r'__END__(\d+)__\r?\n')
+
+# Router session shared between calls, created on first use. It is only reused when the minion runs jobs as
+# threads (multiprocessing: False); with Salt's default of a forked process per job it lasts a single call.
+# The lock keeps concurrent threaded jobs off the same shell.
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# Patterns used to spot errors in command output
+_RE_COMMIT_FAILED = re.compile(r"Commit\s+failed")
+_RE_ANOTHER_COMMIT = re.compile(r"another\s+commit\s+in\s+progress")
+_RE_SET_FAILED = re.compile(r"Set\s+failed")
+_RE_ALREADY_EXISTS = re.compile(r"already exists")
+_RE_NOTHING_TO_DELETE = re.compile(r"Nothing\s+to\s+delete")
+
+# Terminal control sequences (colours, mode switches) that the shell mixes into its output
+_ANSI_RE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
 
 def __virtual__():
     # Only load on vyOS machines.
     if api and HAS_PEXPECT:
         return __virtualname__
     else:
-        log.warning('vyOS module not loaded because the vyOS shell api is not at {}, or the pexpect module is missing.'.format(api))
+        log.warning('vyOS module not loaded because the vyOS shell api is not at %s, or the pexpect module is missing.', api)
         return False
 
 class VyOSError(Exception):
@@ -97,9 +122,29 @@ class Router(object):
         self.codec = "utf8"
 
         # Create a session
-        self.session = pexpect.spawn('su - vyos', echo=False)
-        self.session.sendline('export TERM=xterm')
-        self.session.sendline('set terminal length 0')
+        self.session = pexpect.spawn('su - vyos', echo=False, encoding=self.codec)
+        try:
+            self.session.sendline('export TERM=xterm')
+            self.session.sendline('set terminal length 0')
+
+            # Throw away the login banner so it doesn't end up in the first command's output
+            self._wait_for_end_marker()
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            self.close_session()
+            raise VyOSError("Failed to start a vyos shell session")
+
+    def _wait_for_end_marker(self, command=None):
+        """ Waits for the shell to finish everything sent so far
+
+        :param command: Optional command to run on the same line as the end marker, so no prompt precedes it
+        :returns: int -- Exit status of the last command
+        """
+        if command is None:
+            self.session.sendline(_END_MARKER_COMMAND)
+        else:
+            self.session.sendline('{0}; {1}'.format(command, _END_MARKER_COMMAND))
+        self.session.expect(_END_MARKER)
+        return int(self.session.match.group(1))
 
     def execute_command(self, command, config_mode_required=False):
         """ Executed a command on the router
@@ -110,35 +155,30 @@ class Router(object):
         :raises: VyOSError
         """
 
-        remove_top_lines = 1
-        remove_bottom_lines = 2
-
-        if config_mode_required:
-            remove_top_lines += 3
-            remove_bottom_lines += 1
-            self.session.sendline('config')
-            self.session.sendline(command)
-            self.session.sendline('commit')
-            self.session.sendline('save')
-
-            self.session.sendline('exit')
-        else:
-            self.session.sendline(command)
-
-        self.session.sendline('exit')
-        self.session.expect(pexpect.EOF)
+        try:
+            if config_mode_required:
+                self.session.sendline('{0}; config'.format(_BEGIN_MARKER_COMMAND))
+                self.session.sendline(command)
+                self.session.sendline('commit')
+                self.session.sendline('save')
+
+                # Discard anything a failed commit left behind so the shell is always back in op mode.
+                # The marker's status is that of 'exit discard', so it says nothing about the command.
+                self.session.sendline('exit discard')
+                self._wait_for_end_marker()
+            else:
+                # Run everything on one line so no prompt ends up between the markers
+                status = self._wait_for_end_marker('{0}; {1}'.format(_BEGIN_MARKER_COMMAND, command))
+                log.debug("Command exited with status %s", status)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            raise VyOSError("No response from the vyos shell to: {0}".format(command))
 
-        # Store output from the command in an array
-        output = []
-        for line in self.session.before.splitlines():
-            output.append(line.rstrip('?[m'))
+        # Keep only what was printed after the begin marker
+        output = _BEGIN_MARKER.split(_ANSI_RE.sub('', self.session.before), 1)[-1].splitlines()
 
-        # Remove some of the top and bottom lines of output for readability
-        if len(output) >= 3:
-            for x in range(1, remove_top_lines, 1):
-                del(output[0])
-            for x in range(1, remove_bottom_lines, 1):
-                del(output[-1])
+        # In config mode the last line is the op mode prompt the end marker was typed at
+        if config_mode_required and output:
+            output = output[:-1]
 
         return output
 
@@ -152,12 +192,72 @@ class Router(object):
                 "session_saved": self.session_saved,
                 "conf_mode": self.conf_mode}
 
+    def is_alive(self):
+        """ Returns True if the underlying shell is still running """
+        return self.session.isalive()
+
     def close_session(self):
         """ Close and terminate a session"""
         self.session.close()
         self.session.terminate(force=True)
 
 
+def _get_router():
+    """ Returns the shared Router, starting a new shell if there isn't a live one
+
+    Callers must hold _SESSION_LOCK.
+
+    :returns: Router
+    """
+    global _SESSION
+    if _SESSION is None or not _SESSION.is_alive():
+        _SESSION = Router()
+    return _SESSION
+
+
+def _close_session():
+    """ Closes the shared router session. Callers must hold _SESSION_LOCK, except at interpreter exit.
+
+    :returns: bool -- True if a session was closed
+    """
+    global _SESSION
+    if _SESSION is None:
+        return False
+    _SESSION.close_session()
+    _SESSION = None
+    return True
+
+
+def _run_command(command, config_mode_required=False):
+    """ Runs a command on the shared router session
+
+    The session is dropped if the command fails, so the next call starts from a clean shell instead of
+    reading whatever this one left behind.
+
+    :returns: list -- Command output
+    :raises: VyOSError
+    """
+    with _SESSION_LOCK:
+        router = _get_router()
+        try:
+            return router.execute_command(command, config_mode_required=config_mode_required)
+        except VyOSError:
+            _close_session()
+            raise
+
+
+def close_session():
+    """ Closes the shared router session. The next command will start a new one.
+
+    :returns: bool -- True if a session was closed
+    """
+    with _SESSION_LOCK:
+        return _close_session()
+
+
+atexit.register(_close_session)
+
+
 def run_op_mode_command(command):
     """ Executes a VyOS operational command
 
@@ -167,15 +267,7 @@ def run_op_mode_command(command):
     """
 
     if command.startswith('show'):
-        router = Router()
-        prefix = ""
-        # In cond mode, op mode commands require the "run" prefix
-        if router.conf_mode:
-            prefix = "run"
-
-        output = router.execute_command("{0} {1}".format(prefix, command))
-        router.close_session()
-        return output
+        return _run_command(command)
     else:
         return 'Op mode commands must begin with "show".'
 
@@ -191,10 +283,7 @@ def run_config_mode_command(command, save_changes=False):
 
     if command.startswith(('confirm', 'comment', 'compare', 'copy', 'delete', 'discard', 'edit', 'load', 'loadkey',
                            'merge', 'rename', 'rollback', 'run', 'set', 'show')):
-        router = Router()
-        output = router.execute_command(command, config_mode_required=True)
-        router.close_session()
-        return output
+        return _run_command(command, config_mode_required=True)
 
 
 #####
@@ -217,9 +306,9 @@ def _commit(self):
         else:
             output = self.__execute_command("commit")
 
-            if re.search(r"Commit\s+failed", output):
+            if _RE_COMMIT_FAILED.search(output):
                 raise CommitError(output)
-            if re.search(r"another\s+commit\s+in\s+progress", output):
+            if _RE_ANOTHER_COMMIT.search(output):
                 raise ConfigLocked("Configuration is locked due to another commit in progress")
 
             self.__session_modified = False
@@ -289,9 +378,9 @@ def _set(self, path):
         raise ConfigError("Cannot execute set commands when not in configuration mode")
     else:
         output = self.__execute_command("{0} {1}". format("set", path))
-        if re.search(r"Set\s+failed", output):
+        if _RE_SET_FAILED.search(output):
             raise ConfigError(output)
-        elif re.search(r"already exists", output):
+        elif _RE_ALREADY_EXISTS.search(output):
             raise ConfigError("Configuration path already exists")
         self.__session_modified = True
 
@@ -309,6 +398,6 @@ def _delete(self, path):
         raise ConfigError("Cannot execute delete commands when not in configuration mode")
     else:
         output = self.__execute_command("{0} {1}". format("delete", path))
-        if re.search(r"Nothing\s+to\s+delete", output):
+        if _RE_NOTHING_TO_DELETE.search(output):
             raise ConfigError(output)
         self.__session_modified = True